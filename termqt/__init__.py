@@ -1,11 +1,29 @@
-import platform
+import sys
+from importlib import import_module
 from .terminal_widget import Terminal
 from .terminal_buffer import TerminalBuffer
 from .terminal_io import TerminalIO
 
-platform = platform.system()
+# The platform specific IO backends are only imported on first access, so
+# that using the widget or the buffer alone doesn't pull in pty/termios or
+# winpty. sys.platform is a constant string, unlike platform.system() it
+# doesn't need to query the system.
+if sys.platform == "win32":
+    _io_backends = {
+        "TerminalWinptyIO": ".terminal_io_windows",
+    }
+else:
+    _io_backends = {
+        "TerminalPOSIXIO": ".terminal_io_posix",
+        "TerminalPOSIXExecIO": ".terminal_io_posix",
+    }
 
-if platform in ["Linux", "Darwin"]:
-    from .terminal_io_posix import TerminalPOSIXIO, TerminalPOSIXExecIO
-elif platform == "Windows":
-    from .terminal_io_windows import TerminalWinptyIO
+
+def __getattr__(name):
+    module = _io_backends.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(import_module(module, __name__), name)
+    globals()[name] = value
+    return value
@@ -1,12 +1,11 @@
-from copy import deepcopy
+import re
+import threading
 from typing import NamedTuple
-from enum import Enum
-from functools import partial
-from collections import deque
+from enum import Enum, IntEnum
+from bisect import bisect_right
 
-from qtpy import QT_VERSION
 from qtpy.QtGui import QColor
-from qtpy.QtCore import Qt, QRecursiveMutex, QMutex
+from qtpy.QtCore import Qt
 
 from .colors import colors8, colors16, colors256
 
@@ -40,11 +39,127 @@ class ControlChar(Enum):
     SYN = 22  # Ctrl-V
     ETB = 23  # Ctrl-W, end of xmit block, bash shortcut for cut the word before cursor
     CAN = 24  # Ctrl-X, cancel
-    EM = 25,  # Ctrl-Y, end of medium, bash shortcut for paste
+    EM = 25   # Ctrl-Y, end of medium, bash shortcut for paste
     SUB = 26  # Ctrl-Z, substitute
     ESC = 27  # Ctrl-[, escape
 
 
+# values of the control characters tested for every byte of output, so that
+# hot loops compare against plain ints instead of looking up enum members
+_BEL = ControlChar.BEL.value
+_BS = ControlChar.BS.value
+_TAB = ControlChar.TAB.value
+_LF = ControlChar.LF.value
+_CR = ControlChar.CR.value
+_ESC = ControlChar.ESC.value
+
+# classes of the bytes of a program's output outside of escape sequences,
+# indexed by the value of the byte.
+_OTHER = 0
+_TEXT = 1     # printable ASCII, TAB, or the leading byte of a utf-8 character
+_CONTROL = 2  # control characters handled by the terminal
+_OUTPUT_CLASS = bytes(
+    _TEXT if 32 <= c <= 126 or c >= 0xc0 or c == _TAB else
+    _CONTROL if c in (_BEL, _BS, _LF, _CR) else
+    _OTHER
+    for c in range(256)
+)
+
+# a run of backspaces, e.g. from a line editor moving the cursor back
+_BS_RUN = re.compile(rb"\x08+")
+
+# a run of linebreaks in the text passed to TerminalBuffer.write()
+_LINEBREAK_RUN = re.compile("\n+")
+
+# a run of text: printable ASCII characters, TABs and well-formed multi-byte
+# utf-8 characters, i.e. exactly the bytes that decode as utf-8 one character
+# at a time, so that the whole run can be decoded at once
+_TEXT_RUN = re.compile(
+    rb"(?:[\t\x20-\x7e]"
+    rb"|[\xc2-\xdf][\x80-\xbf]"
+    rb"|\xe0[\xa0-\xbf][\x80-\xbf]"
+    rb"|[\xe1-\xec\xee\xef][\x80-\xbf]{2}"
+    rb"|\xed[\x80-\x9f][\x80-\xbf]"
+    rb"|\xf0[\x90-\xbf][\x80-\xbf]{2}"
+    rb"|[\xf1-\xf3][\x80-\xbf]{3}"
+    rb"|\xf4[\x80-\x8f][\x80-\xbf]{2})+"
+)
+
+# classes of the bytes inside a CSI sequence, indexed by the value of the byte.
+# every class from _SEQ_FINAL on can end a sequence (letters, A-Z, a-z and
+# symbols, exclude [), the CSI handlers test the more specific classes first.
+_SEQ_OTHER = 0
+_SEQ_DIGIT = 1      # 0-9
+_SEQ_FINAL = 2
+_SEQ_MARK = 3       # ?, #, <, >, =
+_SEQ_SEMICOLON = 4  # ;
+_SEQ_CLASS = bytes(
+    _SEQ_DIGIT if 48 <= c <= 57 else
+    _SEQ_SEMICOLON if c == 59 else
+    _SEQ_MARK if c in b"?#<>=" else
+    _SEQ_FINAL if 33 <= c <= 47 or 59 <= c <= 90 or 92 <= c <= 126 else
+    _SEQ_OTHER
+    for c in range(256)
+)
+
+# bytes allowed in an OSC argument: every visible thing except ;
+_OSC_TEXT = bytes(1 if 20 <= c <= 126 and c != 59 else 0 for c in range(256))
+
+# the mark of a CSI sequence is stored as its id, the final byte and the mark
+# id of a sequence together index EscapeProcessor's flat CSI handler table
+_CSI_MARK_ID = {'': 0, '?': 1, '#': 2, '<': 3, '>': 4, '=': 5}
+
+# a complete CSI sequence, exactly as accepted byte by byte by
+# EscapeProcessor's CSI states: an optional mark, the numeric arguments and
+# the final byte. ; is a final byte unless it follows a digit, and a mark
+# right after [ is never taken as the final byte.
+_CSI_SEQUENCE = re.compile(
+    rb"\x1b\[(?:([?#<>=])|(?![?#<>=]))((?:[0-9]+;)*[0-9]*)"
+    rb"([\x21-\x2f\x3c-\x5a\x5c-\x7e]|(?<![0-9]);)"
+)
+
+# what each SGR parameter below 108 does, as (kind, payload):
+#  _SGR_SET: payload is a tuple of (index, value) pairs, applied to the style
+#            (color, bg_color, bold, underline, reverse)
+#  _SGR_COLOR8: 30-37 and 40-47, payload is (index, 8-color, 16-color), the
+#               next parameter selects 8 colors (0) or 16 colors (1)
+#  _SGR_EXTENDED: takes two more parameters, e.g. 38;5;n and 48;5;n
+_SGR_SET = 0
+_SGR_COLOR8 = 1
+_SGR_EXTENDED = 2
+
+
+def _sgr_action(arg):
+    if arg == 0:
+        return _SGR_SET, ((0, DEFAULT_FG_COLOR), (1, DEFAULT_BG_COLOR),
+                          (2, 0), (3, 0), (4, 0))
+    elif arg <= 29:
+        return _SGR_SET, {
+            1: ((2, 1),),   # bold
+            4: ((3, 1),),   # underline
+            7: ((4, 1),),   # reverse
+            22: ((2, 0),),
+            24: ((3, 0),),
+            27: ((4, 0),),
+        }.get(arg, ())
+    elif 30 <= arg <= 37:
+        return _SGR_COLOR8, (0, colors8[arg], colors16[arg])
+    elif 40 <= arg <= 47:
+        return _SGR_COLOR8, (1, colors8[arg - 10], colors16[arg - 10])
+    elif 90 <= arg <= 97:  # foreground 16 colors
+        return _SGR_SET, ((0, colors16[arg - 60]),)
+    elif 100 <= arg <= 107:  # background 16 colors
+        return _SGR_SET, ((1, colors16[arg - 70]),)
+    elif arg == 39:
+        return _SGR_SET, ((0, DEFAULT_FG_COLOR),)
+    elif arg == 49:
+        return _SGR_SET, ((1, DEFAULT_BG_COLOR),)
+    else:
+        return _SGR_EXTENDED, None
+
+
+_SGR_ACTIONS = [_sgr_action(arg) for arg in range(108)]
+
 
 class Placeholder(Enum):
     # Placeholder for correctly display double-width characters
@@ -74,6 +189,28 @@ class Char(NamedTuple):
     reverse: bool = False
 
 
+# placeholder cells carry no style, so a single shared instance of each kind
+# is used for every cell instead of allocating a new one per cell
+_LEAD_CHAR = Char("", 0, Placeholder.LEAD)
+_TAIL_CHAR = Char("", 0, Placeholder.TAIL)
+
+# maximum number of distinct characters kept by TerminalBuffer's Char cache
+# of a style, and maximum number of styles it is kept for
+_CHAR_CACHE_SIZE = 4096
+_CHAR_CACHE_STYLES = 64
+
+
+def to_bytes(string) -> bytes:
+    # Convert the output of a program to bytes once, so that the parser only
+    # deals with integers. str is encoded as utf-8, bytes-like objects
+    # (bytearray, memoryview) are copied into bytes.
+    if isinstance(string, bytes):
+        return string
+    if isinstance(string, str):
+        return string.encode("utf-8")
+    return bytes(string)
+
+
 class Position(NamedTuple):
     x: int
     y: int
@@ -82,8 +219,10 @@ class Position(NamedTuple):
 class EscapeProcessor:
     # A state machine used to process control sequences, etc.
 
-    class State(Enum):
+    class State(IntEnum):
         # state of the state machine
+        # an IntEnum, so that members compare equal to the integer kept in
+        # _state
         # initial state, 0
         WAIT_FOR_ESC = 0
         # once entered, reset all buffers
@@ -138,14 +277,51 @@ class EscapeProcessor:
         G0_COMPLETE = 11
         # once entered, process the input and return to WAIT_FOR_ESC
 
+    # _state holds the integer value of the state rather than the enum member,
+    # so that it can index the handler table directly
+    _WAIT_FOR_ESC = State.WAIT_FOR_ESC.value
+    _WAIT_FOR_BRAC_OR_CHAR = State.WAIT_FOR_BRAC_OR_CHAR.value
+    _CSI_WAIT_FOR_MARKS = State.CSI_WAIT_FOR_MARKS.value
+    _CSI_WAIT_FOR_NEXT_ARG = State.CSI_WAIT_FOR_NEXT_ARG.value
+    _CSI_WAIT_FOR_ARG_FINISH = State.CSI_WAIT_FOR_ARG_FINISH.value
+    _ESC_COMPLETE = State.ESC_COMPLETE.value
+    _CSI_COMPLETE = State.CSI_COMPLETE.value
+    _OSC_WAIT_FOR_NEXT_ARG = State.OSC_WAIT_FOR_NEXT_ARG.value
+    _OSC_WAIT_FOR_ARG_FINISH = State.OSC_WAIT_FOR_ARG_FINISH.value
+    _OSC_COMPLETE = State.OSC_COMPLETE.value
+    _G0_WAIT_FOR_ARG = State.G0_WAIT_FOR_ARG.value
+    _G0_COMPLETE = State.G0_COMPLETE.value
+
     def __init__(self, logger):
         self.logger = logger
-        self._state = self.State.WAIT_FOR_ESC
+        self._state = self._WAIT_FOR_ESC
         self._args = []
-        self._arg_buf = ""
-        self._cmd = ""
-        self._mark = ""
-        self._buffer = ""
+        # the raw bytes of the sequence and of the (OSC) argument being read
+        # are collected in bytearrays, and only converted when they are used
+        self._arg_buf = bytearray()
+        # the numeric CSI argument being read, accumulated digit by digit
+        self._arg_val = 0
+        # the final byte of the sequence and the id of its mark
+        self._cmd = 0
+        self._mark = 0
+        self._buffer = bytearray()
+
+        # input() dispatches on the current state through this table, one
+        # handler per state, indexed by the value of the state
+        self._handlers = [self._h_complete] * len(self.State)
+        self._handlers[self._WAIT_FOR_ESC] = self._h_wait_for_esc
+        self._handlers[self._WAIT_FOR_BRAC_OR_CHAR] = \
+            self._h_wait_for_brac_or_char
+        self._handlers[self._CSI_WAIT_FOR_MARKS] = self._h_csi_wait_for_marks
+        self._handlers[self._CSI_WAIT_FOR_NEXT_ARG] = \
+            self._h_csi_wait_for_next_arg
+        self._handlers[self._CSI_WAIT_FOR_ARG_FINISH] = \
+            self._h_csi_wait_for_arg_finish
+        self._handlers[self._OSC_WAIT_FOR_NEXT_ARG] = \
+            self._h_osc_wait_for_next_arg
+        self._handlers[self._OSC_WAIT_FOR_ARG_FINISH] = \
+            self._h_osc_wait_for_arg_finish
+        self._handlers[self._G0_WAIT_FOR_ARG] = self._h_g0_wait_for_arg
 
         self._esc_func = {
             'M': self._esc_m,
@@ -167,10 +343,20 @@ class EscapeProcessor:
             'K': self._csi_K,
             'M': self._csi_M,
             '@': self._csi_AT,
-            'h?': partial(self._csi_h_l_ext, True),
-            'l?': partial(self._csi_h_l_ext, False)
+            'h?': self._csi_h_ext,
+            'l?': self._csi_l_ext
         }
 
+        # flat tables of the functions above, indexed by the final byte (plus
+        # 128 times the mark id for CSI), unknown commands fail
+        self._esc_table = [self.fail] * 128
+        for cmd, func in self._esc_func.items():
+            self._esc_table[ord(cmd)] = func
+
+        self._csi_table = [self.fail] * (128 * len(_CSI_MARK_ID))
+        for cmd, func in self._csi_func.items():
+            self._csi_table[128 * _CSI_MARK_ID[cmd[1:]] + ord(cmd[0])] = func
+
         # ==== Callbacks ====
 
         # Reverse Index
@@ -220,7 +406,7 @@ class EscapeProcessor:
 
         # Cursor Position Report
         #  return the position of the cursor in the format of
-        #   \x1b[{row}{col}R
+        #   \x1b[{row};{col}R
         #  NOTE: row and col begin from 1
         self.report_cursor_position_cb = lambda: None
 
@@ -283,166 +469,189 @@ class EscapeProcessor:
         #   - 1, if the input finishes a control sequence
         # otherwise return True.
 
-        if self._state != self.State.WAIT_FOR_ESC:
-            self._buffer += chr(c)
-
-        if self._state == self.State.WAIT_FOR_ESC:
-            if c == ControlChar.ESC.value:
-                self._enter_state(self.State.WAIT_FOR_BRAC_OR_CHAR)
-            else:
-                return -1
-
-        elif self._state == self.State.WAIT_FOR_BRAC_OR_CHAR:
-            if c == 91:  # ord('[')
-                self._enter_state(self.State.CSI_WAIT_FOR_MARKS)
-            elif c == 93:  # ord(']')
-                self._enter_state(self.State.OSC_WAIT_FOR_NEXT_ARG)
-            elif c == 40:  # ord('(')
-                self._enter_state(self.State.G0_WAIT_FOR_ARG)
-            elif 33 <= c <= 126:  # anything else
-                self._cmd = chr(c)
-                self._enter_state(self.State.ESC_COMPLETE)
-                return 1
-            else:
-                self.fail()
-
-        elif self._state == self.State.CSI_WAIT_FOR_MARKS:
-            if c in [ord('?'), ord('#'), ord('<'), ord('>'), ord('=')]:
-                self._mark = chr(c)
-                self._enter_state(self.State.CSI_WAIT_FOR_NEXT_ARG)
-            elif 48 <= c <= 57:  # digits, 0-9
-                self._arg_buf += chr(c)
-                self._enter_state(self.State.CSI_WAIT_FOR_ARG_FINISH)
-            elif 33 <= c <= 47 or 59 <= c <= 90 or 92 <= c <= 126:
-                # letters, A-Z, a-z and symbols, exclude [
-                self._cmd = chr(c)
-                self._enter_state(self.State.CSI_COMPLETE)
-                return 1
-            else:
-                self.fail()
-
-        elif self._state == self.State.CSI_WAIT_FOR_NEXT_ARG:
-            if 48 <= c <= 57:  # digits, 0-9
-                self._arg_buf += chr(c)
-                self._enter_state(self.State.CSI_WAIT_FOR_ARG_FINISH)
-            elif 33 <= c <= 47 or 59 <= c <= 90 or 92 <= c <= 126:
-                # letters, A-Z, a-z and symbols, exclude [
-                self._cmd = chr(c)
-                self._enter_state(self.State.CSI_COMPLETE)
-                return 1
-            else:
-                self.fail()
-
-        elif self._state == self.State.CSI_WAIT_FOR_ARG_FINISH:
-            if 48 <= c <= 57:  # digits, 0-9
-                self._arg_buf += chr(c)
-            elif c == 59:  # ord(';')
-                self._args.append(int(self._arg_buf))
-                self._arg_buf = ""
-                self._enter_state(self.State.CSI_WAIT_FOR_NEXT_ARG)
-            elif 33 <= c <= 47 or 59 <= c <= 90 or 92 <= c <= 126:
-                # letters, A-Z, a-z and symbols, exclude [
-                self._args.append(int(self._arg_buf))
-                self._cmd = chr(c)
-                self._enter_state(self.State.CSI_COMPLETE)
-                return 1
-            else:
-                self.fail()
-
-        elif self._state == self.State.CSI_COMPLETE:
-            # this branch should never be reached
+        state = self._state
+        if state != self._WAIT_FOR_ESC:
+            self._buffer.append(c)
+
+        return self._handlers[state](c)
+
+    def _h_wait_for_esc(self, c):
+        if c == _ESC:
+            self._enter_state(self._WAIT_FOR_BRAC_OR_CHAR)
+            return 0
+        return -1
+
+    def _h_wait_for_brac_or_char(self, c):
+        if c == 91:  # ord('[')
+            self._enter_state(self._CSI_WAIT_FOR_MARKS)
+        elif c == 93:  # ord(']')
+            self._enter_state(self._OSC_WAIT_FOR_NEXT_ARG)
+        elif c == 40:  # ord('(')
+            self._enter_state(self._G0_WAIT_FOR_ARG)
+        elif 33 <= c <= 126:  # anything else
+            self._cmd = c
+            self._enter_state(self._ESC_COMPLETE)
+            return 1
+        else:
             self.fail()
+        return 0
 
-        # === OSC ===
-        elif self._state == self.State.OSC_WAIT_FOR_NEXT_ARG:
-            if 20 <= c <= 126 and c != 59:  # every visible thing except ;
-                self._arg_buf += chr(c)
-                self._enter_state(self.State.OSC_WAIT_FOR_ARG_FINISH)
-                return 1
-            else:
-                self.fail()
-
-        elif self._state == self.State.OSC_WAIT_FOR_ARG_FINISH:
-            if 20 <= c <= 126 and c != 59:  # every visible thing except ;
-                self._arg_buf += chr(c)
-                return 1
-            elif c == 59:  # ord(';')
-                self._args.append(self._arg_buf)
-                self._arg_buf = ""
-                self._enter_state(self.State.OSC_WAIT_FOR_NEXT_ARG)
-                return 1
-            elif c == 7 or c == 27:  # BEL, \x07 or ESC, \x1b
-                self._args.append(self._arg_buf)
-                self._enter_state(self.State.OSC_COMPLETE)
-                return 1
-            else:
-                self.fail()
+    def _h_csi_wait_for_marks(self, c):
+        cls = _SEQ_CLASS[c]
+        if cls == _SEQ_MARK:
+            self._mark = _CSI_MARK_ID[chr(c)]
+            self._enter_state(self._CSI_WAIT_FOR_NEXT_ARG)
+        elif cls == _SEQ_DIGIT:
+            self._arg_val = c - 48
+            self._enter_state(self._CSI_WAIT_FOR_ARG_FINISH)
+        elif cls >= _SEQ_FINAL:
+            self._cmd = c
+            self._enter_state(self._CSI_COMPLETE)
+            return 1
+        else:
+            self.fail()
+        return 0
 
-        elif self._state == self.State.OSC_COMPLETE:
-            # this branch should never be reached
+    def _h_csi_wait_for_next_arg(self, c):
+        cls = _SEQ_CLASS[c]
+        if cls == _SEQ_DIGIT:
+            self._arg_val = c - 48
+            self._enter_state(self._CSI_WAIT_FOR_ARG_FINISH)
+        elif cls >= _SEQ_FINAL:
+            self._cmd = c
+            self._enter_state(self._CSI_COMPLETE)
+            return 1
+        else:
             self.fail()
+        return 0
 
-        # === G0 ===
-        elif self._state == self.State.G0_WAIT_FOR_ARG:
-            self._args.append(chr(c))
-            self._enter_state(self.State.G0_COMPLETE)
+    def _h_csi_wait_for_arg_finish(self, c):
+        cls = _SEQ_CLASS[c]
+        if cls == _SEQ_DIGIT:
+            self._arg_val = self._arg_val * 10 + (c - 48)
+        elif cls == _SEQ_SEMICOLON:
+            self._args.append(self._arg_val)
+            self._arg_val = 0
+            self._enter_state(self._CSI_WAIT_FOR_NEXT_ARG)
+        elif cls >= _SEQ_FINAL:
+            self._args.append(self._arg_val)
+            self._cmd = c
+            self._enter_state(self._CSI_COMPLETE)
             return 1
+        else:
+            self.fail()
+        return 0
 
-        elif self._state == self.State.G0_COMPLETE:
-            # this branch should never be reached
+    # === OSC ===
+    def _h_osc_wait_for_next_arg(self, c):
+        if _OSC_TEXT[c]:
+            self._arg_buf.append(c)
+            self._enter_state(self._OSC_WAIT_FOR_ARG_FINISH)
+            return 1
+        else:
             self.fail()
 
+    def _h_osc_wait_for_arg_finish(self, c):
+        if _OSC_TEXT[c]:
+            self._arg_buf.append(c)
+            return 1
+        elif c == 59:  # ord(';')
+            self._args.append(self._arg_buf.decode())
+            self._arg_buf.clear()
+            self._enter_state(self._OSC_WAIT_FOR_NEXT_ARG)
+            return 1
+        elif c == 7 or c == 27:  # BEL, \x07 or ESC, \x1b
+            self._args.append(self._arg_buf.decode())
+            self._enter_state(self._OSC_COMPLETE)
+            return 1
         else:
-            raise ValueError(f"Unhandle state {self._state}")
+            self.fail()
 
-        return 0
+    # === G0 ===
+    def _h_g0_wait_for_arg(self, c):
+        self._args.append(chr(c))
+        self._enter_state(self._G0_COMPLETE)
+        return 1
+
+    def _h_complete(self, c):
+        # the *_COMPLETE states are left as soon as they are entered,
+        # this handler should never be reached
+        self.fail()
+
+    def feed(self, data: bytes, pos=0):
+        # Feed the escape sequence in progress, or the one beginning at
+        # data[pos], to the state machine byte by byte, until the sequence is
+        # finished (or rejected) or data runs out. Nothing is consumed if
+        # no sequence is in progress and data[pos] isn't ESC, which allows
+        # the caller to skip ordinary text without calling input() per byte.
+        #
+        # return: the index of the first byte not consumed.
+        n = len(data)
+        wait_for_esc = self._WAIT_FOR_ESC
+        if self._state == wait_for_esc:
+            if pos >= n or data[pos] != _ESC:
+                return pos
+
+            m = _CSI_SEQUENCE.match(data, pos)
+            if m:
+                # the whole CSI sequence is here, take it in one step
+                # instead of running the state machine over each byte
+                mark, args, cmd = m.groups()
+                self._buffer += data[pos + 1:m.end()]
+                self._mark = _CSI_MARK_ID[chr(mark[0])] if mark else 0
+                self._args = [int(arg) for arg in args.split(b";") if arg]
+                self._cmd = cmd[0]
+                try:
+                    self._enter_state(self._CSI_COMPLETE)
+                except ValueError as e:
+                    self.logger.debug(e)
+                return m.end()
+
+        while pos < n:
+            c = data[pos]
+            pos += 1
+            try:
+                self.input(c)
+            except ValueError as e:
+                self.logger.debug(e)
+                break
+
+            if self._state == wait_for_esc:
+                break
+
+        return pos
 
     def _enter_state(self, _state):
-        if _state == self.State.ESC_COMPLETE:
-            self._state = self.State.ESC_COMPLETE
+        self._state = _state
+        if _state == self._ESC_COMPLETE:
             self._process_esc_command()
             self.reset()
-        elif _state == self.State.CSI_COMPLETE:
-            self._state = self.State.CSI_COMPLETE
+        elif _state == self._CSI_COMPLETE:
             self._process_csi_command()
             self.reset()
-        elif _state == self.State.OSC_COMPLETE:
-            self._state = self.State.OSC_COMPLETE
+        elif _state == self._OSC_COMPLETE:
             self._process_osc_command()
             self.reset()
-        elif _state == self.State.G0_COMPLETE:
-            self._state = self.State.G0_COMPLETE
+        elif _state == self._G0_COMPLETE:
             pass # Not implemented
             self.reset()
-        else:
-            self._state = _state
 
     def _process_esc_command(self):
-        assert self._state == self.State.ESC_COMPLETE
+        assert self._state == self._ESC_COMPLETE
 
-        cmd = self._cmd
-
-        if cmd in self._esc_func:
-            # self.logger.debug(f"escape: fired {self._buffer}")
-            self._esc_func[cmd]()
-            self.reset()
-        else:
-            self.fail()
+        # self.logger.debug(f"escape: fired {self._buffer}")
+        self._esc_table[self._cmd]()
+        self.reset()
 
     def _process_csi_command(self):
-        assert self._state == self.State.CSI_COMPLETE
-
-        cmd = self._cmd if not self._mark else (self._cmd + self._mark)
+        assert self._state == self._CSI_COMPLETE
 
-        if cmd in self._csi_func:
-            # self.logger.debug(f"escape: fired {self._buffer}")
-            self._csi_func[cmd]()
-            self.reset()
-        else:
-            self.fail()
+        # self.logger.debug(f"escape: fired {self._buffer}")
+        self._csi_table[128 * self._mark + self._cmd]()
+        self.reset()
 
     def _process_osc_command(self):
-        assert self._state == self.State.OSC_COMPLETE
+        assert self._state == self._OSC_COMPLETE
         try:
             op = int(self._args[0])
             if op in [0, 1, 2]:
@@ -459,14 +668,15 @@ class EscapeProcessor:
 
     def reset(self):
         self._args = []
-        self._cmd = ""
-        self._buffer = ""
-        self._arg_buf = ""
-        self._mark = ""
-        self._state = self.State.WAIT_FOR_ESC
+        self._cmd = 0
+        self._buffer.clear()
+        self._arg_buf.clear()
+        self._arg_val = 0
+        self._mark = 0
+        self._state = self._WAIT_FOR_ESC
 
     def fail(self):
-        buf = self._buffer.encode('utf-8')
+        buf = bytes(self._buffer)
         self.reset()
         raise ValueError("Unable to process escape sequence "
                          f"{buf}.")
@@ -490,11 +700,11 @@ class EscapeProcessor:
 
     def _csi_J(self):
         # ED – Erase In Display
-        self.erase_display_cb(self._get_args(0, default=0))
+        self.erase_display_cb(self._args[0] if self._args else 0)
 
     def _csi_K(self):
         # EL – Erase In Line
-        self.erase_line_cb(self._get_args(0, default=0))
+        self.erase_line_cb(self._args[0] if self._args else 0)
 
     def _csi_P(self):
         self.erase_line_cb(0)
@@ -504,6 +714,10 @@ class EscapeProcessor:
 
     def _csi_H(self):
         # CUP – Cursor On-Screen Position
+        if not self._args:
+            # \x1b[H, home
+            self.set_cursor_abs_position_cb(0, 0)
+            return
         self.set_cursor_abs_position_cb(
             self._get_args(1, default=1) - 1,
             self._get_args(0, default=1) - 1  # begin from 1 -> begin from 0
@@ -511,19 +725,23 @@ class EscapeProcessor:
 
     def _csi_A(self):
         # Cursor Up
-        self.set_cursor_rel_position_cb(0, -1 * self._get_args(0, default=1))
+        n = self._args[0] if self._args else 1
+        self.set_cursor_rel_position_cb(0, -n)
 
     def _csi_B(self):
         # Cursor Down
-        self.set_cursor_rel_position_cb(0, +1 * self._get_args(0, default=1))
+        n = self._args[0] if self._args else 1
+        self.set_cursor_rel_position_cb(0, n)
 
     def _csi_C(self):
         # Cursor Right
-        self.set_cursor_rel_position_cb(+1 * self._get_args(0, default=1), 0)
+        n = self._args[0] if self._args else 1
+        self.set_cursor_rel_position_cb(n, 0)
 
     def _csi_D(self):
         # Cursor Left
-        self.set_cursor_rel_position_cb(-1 * self._get_args(0, default=1), 0)
+        n = self._args[0] if self._args else 1
+        self.set_cursor_rel_position_cb(-n, 0)
 
     def _csi_G(self):
         # Cursor Horizontal Absolute
@@ -536,95 +754,57 @@ class EscapeProcessor:
 
     def _csi_m(self):
         # Colors and decorators
-        color = None
-        bg_color = None
-        bold, underline, reverse = -1, -1, -1
+        # style: color, bg_color, bold, underline, reverse, in the form passed
+        # to set_style_cb
+        args = self._args
+        if not args:
+            # \x1b[m, reset
+            self.set_style_cb(DEFAULT_FG_COLOR, DEFAULT_BG_COLOR, 0, 0, 0)
+            return
 
+        style = [None, None, -1, -1, -1]
+        n = len(args)
         i = 0
-
-        if len(self._args) == 0:
-            bold, underline, reverse = 0, 0, 0
-            color = DEFAULT_FG_COLOR
-            bg_color = DEFAULT_BG_COLOR
-
-        while i < len(self._args):
-            arg = self._get_args(i, default=0)
-            if 0 <= arg <= 29:
+        while i < n:
+            arg = args[i]
+            kind, payload = _SGR_ACTIONS[arg] if arg < len(_SGR_ACTIONS) \
+                else (_SGR_EXTENDED, None)
+
+            if kind == _SGR_SET:
+                for index, value in payload:
+                    style[index] = value
                 i += 1
-                if arg == 0:
-                    bold, underline, reverse = 0, 0, 0
-                    color = DEFAULT_FG_COLOR
-                    bg_color = DEFAULT_BG_COLOR
-                elif arg == 1:
-                    bold = 1
-                elif arg == 4:
-                    underline = 1
-                elif arg == 7:
-                    reverse = 1
-                elif arg == 22:
-                    bold = 0
-                elif arg == 24:
-                    underline = 0
-                elif arg == 27:
-                    reverse = 0
-                continue
 
-            elif 30 <= arg <= 37 or 40 <= arg <= 47 or \
-                    90 <= arg <= 97 or 100 <= arg <= 107:
-                if arg >= 90:
-                    arg -= 60
-                    arg1 = 1
-                    i += 1
+            elif kind == _SGR_COLOR8:
+                arg1 = args[i + 1] if i + 1 < n else 0
+                if arg1 == 0 or arg1 == 1:
+                    # 0: 8 colors, 1: 16 colors
+                    style[payload[0]] = payload[1 + arg1]
+                    i += 2
                 else:
-                    if i + 1 < len(self._args):
-                        arg1 = self._get_args(i+1, default=0)
-                    else:
-                        arg1 = 0
-
-                    if arg1 == 0 or arg1 == 1:
-                        i += 2
-                    else:
-                        i += 1
-
-                if arg <= 37:
-                    if arg1 == 0:  # foreground 8 colors
-                        color = colors8[arg]
-                    elif arg1 == 1:  # foreground 16 colors
-                        color = colors16[arg]
-                elif 40 <= arg < 50:
-                    if arg1 == 0:  # background 8 colors
-                        bg_color = colors8[arg - 10]
-                    elif arg1 == 1:  # background 16 colors
-                        bg_color = colors16[arg - 10]
-                continue
-
-            elif arg == 39:
-                i += 1
-                color = DEFAULT_FG_COLOR
-                continue
-
-            elif arg == 49:
-                i += 1
-                bg_color = DEFAULT_BG_COLOR
-                continue
+                    i += 1
 
             else:
-                if i + 2 < len(self._args):  # need two consecuted args
-                    arg1 = self._get_args(i+1, default=0)
-                    arg2 = self._get_args(i+2, default=0)
+                if i + 2 < n:  # need two consecuted args
+                    arg1 = args[i + 1]
+                    arg2 = args[i + 2]
                     i += 3
-                    if arg == 38 and arg1 == 5 and 0 <= arg2 <= 255:
+                    if arg1 == 5 and 0 <= arg2 <= 255:
                         # xterm 256 colors
-                        color = colors256[arg2]
-
-                    elif arg == 48 and arg1 == 5 and 0 <= arg2 <= 255:
-                        # xterm 256 colors
-                        bg_color = colors256[arg2]
-                    continue
+                        if arg == 38:
+                            style[0] = colors256[arg2]
+                        elif arg == 48:
+                            style[1] = colors256[arg2]
                 else:
                     break
 
-        self.set_style_cb(color, bg_color, bold, underline, reverse)
+        self.set_style_cb(*style)
+
+    def _csi_h_ext(self):
+        self._csi_h_l_ext(True)
+
+    def _csi_l_ext(self):
+        self._csi_h_l_ext(False)
 
     def _csi_h_l_ext(self, on):
         arg = self._get_args(0, default=0)
@@ -651,12 +831,15 @@ class TerminalBuffer:
         self.logger = logger
 
         # initialize a buffer to store all characters to display
-        # define in _resize()_ as a deque
+        # define in _resize()_ as a list of rows, each row a list of cells
         self._buffer = None
-        if QT_VERSION.startswith('6'):
-            self._buffer_lock =QRecursiveMutex()
-        else:
-            self._buffer_lock = QMutex(QMutex.Recursive)
+        # rows dropped from the top of the history, recycled by _new_row()
+        # as new rows at the bottom, and the blank row they are reset to
+        self._spare_rows = []
+        self._blank_row = []
+        # recursive, _stdout() holds it while calling write() and the other
+        # editing functions, which take it again
+        self._buffer_lock = threading.RLock()
 
         self.auto_wrap_enabled = auto_wrap_enabled
         # used to store the line number of lines that are wrapped automatically
@@ -680,6 +863,17 @@ class TerminalBuffer:
         self._underline = False
         self._reversed = False
 
+        # Char objects written so far, by style and then by character. cells
+        # showing the same character in the same style share one object,
+        # also when other styles were used in between, which lets the
+        # widget resolve the glyph of each object once per paint.
+        # Styles are keyed by the id() of their colors, the cached Char
+        # objects keep the colors alive so that the ids aren't reused.
+        self._char_caches = {}
+        # display width of the characters seen so far, kept across style
+        # changes, since get_char_width() may have to measure the glyph
+        self._char_width_cache = {}
+
         self.row_len = row_len
         self.col_len = col_len
 
@@ -821,8 +1015,7 @@ class TerminalBuffer:
         ep.set_cursor_abs_position_cb = self.set_cursor_on_screen_position
         ep.set_cursor_rel_position_cb = self.set_cursor_rel_pos
         ep.set_cursor_x_position_cb = self.set_cursor_x_pos
-        ep.report_device_status_cb = lambda: self.stdin_callback(
-            "\x1b[0n".encode("utf-8"))
+        ep.report_device_status_cb = lambda: self.stdin_callback(b"\x1b[0n")
         ep.report_cursor_position_cb = self.report_cursor_pos
         ep.set_style_cb = self.set_style
         ep.use_alt_buffer = self.toggle_alt_screen
@@ -849,17 +1042,15 @@ class TerminalBuffer:
     # ==========================
 
     def clear_buffer(self):
-        _new_buffer = deque([[None for x in range(self.row_len)]
-                             for i in range(self.col_len)])
-        _new_wrap = deque([False for i in range(self.col_len)])
+        _new_buffer = [self._new_row() for i in range(self.col_len)]
+        _new_wrap = [False] * self.col_len
 
         self._buffer = _new_buffer
         self._line_wrapped_flags = _new_wrap
 
     def create_buffer(self, row_len, col_len):
-        _new_buffer = deque([[None for x in range(row_len)]
-                             for i in range(col_len)])
-        _new_wrap = deque([False for i in range(col_len)])
+        _new_buffer = [[None] * row_len for i in range(col_len)]
+        _new_wrap = [False] * col_len
 
         self.logger.info(f"screen: buffer created, size ({row_len}x"
                          f"{col_len})")
@@ -884,30 +1075,32 @@ class TerminalBuffer:
             self.create_buffer(row_len, col_len)
             return
 
-        self._buffer_lock.lock()
-
         old_row_len = self.row_len
         old_buf_col_len = len(self._buffer)
 
         if old_row_len == row_len:
-            self.col_len = col_len
-            self._buffer_display_offset = max(len(self._buffer) - self.col_len, 0)
-            self.update_scroll_position()
-
-            self._buffer_lock.unlock()
+            with self._buffer_lock:
+                self.col_len = col_len
+                self._buffer_display_offset = max(len(self._buffer) - self.col_len, 0)
+                self.update_scroll_position()
             self.resize_callback(col_len, row_len)
             return
 
+        # The reflow below only reads the old buffer and builds the new one
+        # in local variables, the lock is held just for swapping it in.
+        old_buf = self._buffer
+        old_wrap = self._line_wrapped_flags
+
         old_auto_breaks_before_cursor = 0
         for i in range(cur_y):
-            if self._line_wrapped_flags[i]:
+            if old_wrap[i]:
                 old_auto_breaks_before_cursor += 1
 
         self.logger.info(f"screen: resize triggered, new size ({row_len}x"
                          f"{col_len})")
 
-        _new_buffer = deque([[None for x in range(row_len)]])
-        _new_wrap = deque([False])
+        _new_buffer = [[None] * row_len]
+        _new_wrap = [False]
 
         new_y = 0
         new_x = 0
@@ -926,27 +1119,39 @@ class TerminalBuffer:
         # the old row, criteria 1 and 2 will be satisfied simultaneously,
         # we must be careful not to create two linebreaks but only one.
 
-        for y, old_row in enumerate(self._buffer):
+        for y, old_row in enumerate(old_buf):
             if y > 0:
                 # if last line was unfinished and was automantically
                 # wrapped into the next line in the old screen, this flag
                 # will be True, which means we don't need to wrap it again
-                if not self._line_wrapped_flags[y-1]:
+                if not old_wrap[y-1]:
                     if not breaked:
                         # The _breaked_ flag is used to avoid
                         # breaking the same line twice
                         # under the case that the new row length is the
                         # integer multiple of the length of the old row
-                        _new_buffer.append([None for x in range(row_len)])
+                        _new_buffer.append([None] * row_len)
                         _new_wrap.append(False)
                         new_y += 1
                         new_x = 0
 
+            # indices of the cells that are not plain single-width cells
+            # (wide characters and placeholders), the cells in between are
+            # moved into the new buffer in runs
+            stops = [i for i, c in enumerate(old_row)
+                     if c and c.char_width != 1]
+            stops.append(len(old_row))
+
+            # index of the last real character in the row, there is nothing
+            # left to move from this row once it is passed
+            last_real = len(old_row) - 1
+            while last_real >= 0 and not (
+                    old_row[last_real] and
+                    old_row[last_real].placeholder == Placeholder.NON):
+                last_real -= 1
+
             x = -1
             while x + 1 < len(old_row):
-                x += 1
-                c = old_row[x]
-
                 # clear _breaked_ flag
                 # note that it should only be set when the new row length
                 # is the integer multiple of the length of the old row
@@ -954,41 +1159,51 @@ class TerminalBuffer:
                 # inserted
                 breaked = False
 
-                if c and c.placeholder == Placeholder.LEAD:
-                    continue
+                end = min(stops[bisect_right(stops, x)],
+                          x + 1 + row_len - new_x)
+                if end > x + 1:
+                    # copy the run of plain cells, as much as fits into
+                    # this row
+                    _new_buffer[new_y][new_x:new_x + end - x - 1] = \
+                        old_row[x + 1:end]
+                    new_x += end - x - 1
+                    x = end - 1
+                else:
+                    x += 1
+                    c = old_row[x]
 
-                width = c.char_width if c else 1
+                    if c.placeholder == Placeholder.LEAD:
+                        continue
 
-                if new_x + width > row_len:
-                    # char too wide to fit into this row
-                    while new_x < row_len:
-                        _new_buffer[new_y][new_x] = Char("", 0, Placeholder.LEAD)
+                    if new_x + c.char_width > row_len:
+                        # char too wide to fit into this row
+                        while new_x < row_len:
+                            _new_buffer[new_y][new_x] = _LEAD_CHAR
+                            new_x += 1
+                        x -= 1
+                    else:
+                        _new_buffer[new_y][new_x] = c
                         new_x += 1
-                    x -= 1
-                else:
-                    _new_buffer[new_y][new_x] = c
-                    new_x += 1
 
                 if new_x >= row_len:
                     if not do_auto_wrap:
                         new_x = row_len - 1
                         continue
 
-                    empty_ahead = all(map(lambda c: not c or c.placeholder != Placeholder.NON,
-                                          old_row[x+1:]))
+                    empty_ahead = x >= last_real
 
                     if y == old_buf_col_len - 1 and empty_ahead:
                         # avoid creating extra new lines after last line
                         break
 
-                    _new_buffer.append([None for x in range(row_len)])
+                    _new_buffer.append([None] * row_len)
                     _new_wrap.append(False)
                     new_y += 1
                     new_x = 0
                     breaked = True
 
                     if empty_ahead and \
-                            not self._line_wrapped_flags[y]:
+                            not old_wrap[y]:
                         # avoid wrapping a bunch of spaces into next line
                         break
                     else:
@@ -1006,105 +1221,179 @@ class TerminalBuffer:
         filler = old_buf_col_len - len(_new_buffer)
         if filler > 0:
             cur_y += filler
+            _new_buffer[:0] = [[None] * row_len for i in range(filler)]
+            _new_wrap[:0] = [False] * filler
 
-        for i in range(filler):
-            _new_buffer.appendleft([None for x in range(row_len)])
-            _new_wrap.appendleft(False)
-
-        while len(self._buffer) > self.maximum_line_history:
-            _new_buffer.popleft()
-            self._line_wrapped_flags.popleft()
-            cur_y -= 1
-
-        self.row_len = row_len
-        self.col_len = col_len
-        self._buffer = _new_buffer
-        self._buffer_display_offset = len(self._buffer) - self.col_len
-        self.update_scroll_position()
+        with self._buffer_lock:
+            cur_y -= self._trim_history(_new_buffer, _new_wrap)
 
-        self._line_wrapped_flags = _new_wrap
-        # self.logger.info(f"cursor: ({cur_x}, {cur_y})")
-        self._cursor_position = Position(min(cur_x, row_len), cur_y)
+            self.row_len = row_len
+            self.col_len = col_len
+            self._buffer = _new_buffer
+            self._buffer_display_offset = len(self._buffer) - self.col_len
+            self.update_scroll_position()
 
-        self._buffer_lock.unlock()
+            self._line_wrapped_flags = _new_wrap
+            # self.logger.info(f"cursor: ({cur_x}, {cur_y})")
+            self._cursor_position = Position(min(cur_x, row_len), cur_y)
 
         self.resize_callback(col_len, row_len)
         # self._log_buffer()
 
+    def _trim_history(self, buf, wrap_flags):
+        # Drop the oldest lines exceeding maximum_line_history from _buf_ and
+        # the corresponding _wrap_flags, all at once.
+        # ret: the number of lines dropped
+        excess = len(buf) - self.maximum_line_history
+        if excess <= 0:
+            return 0
+
+        # keep up to a screenful of the dropped rows for reuse
+        room = self.col_len - len(self._spare_rows)
+        if room > 0:
+            self._spare_rows.extend(buf[:min(excess, room)])
+
+        del buf[:excess]
+        del wrap_flags[:excess]
+        return excess
+
+    def _blank_template(self):
+        # A row of empty cells, kept for copying blank rows from. Never put
+        # it into the buffer itself.
+        blank = self._blank_row
+        if len(blank) != self.row_len:
+            blank = self._blank_row = [None] * self.row_len
+        return blank
+
+    def _new_row(self):
+        # A blank row to be appended to the buffer. Rows dropped from the
+        # history are reused, so that scrolling in steady state doesn't
+        # allocate a new list for every line.
+        blank = self._blank_template()
+
+        if self._spare_rows:
+            row = self._spare_rows.pop()
+            row[:] = blank  # also fixes up the length of an older row
+            return row
+        return blank.copy()
+
     def write(self, text, pos: Position = None, set_cursor=False,
               reset_offset=True):
         # _pos_ is position on the screen, not position on the buffer
 
-        self._buffer_lock.lock()
-
-        buf = self._buffer
-
-        offset = len(self._buffer) - self.col_len
-        row_len = self.row_len
-
-        if not pos:
-            pos = self._cursor_position
-            pos_x = pos.x
-            pos_y = pos.y
-        else:
-            pos_x = pos.x
-            pos_y = pos.y + offset
-
+        # the characters to write are prepared before taking the lock, which
+        # is held only while the buffer is being changed
         color, bgcolor = self._fg_color, self._bg_color
         bold, underline, reverse = self._bold, self._underline, self._reversed
         do_auto_wrap = self.auto_wrap_enabled
 
-        char_list = [Char(t, self.get_char_width(t), Placeholder.NON, color, bgcolor,
-                          bold, underline, reverse) for t in text]
-
-        i = -1
-        while i + 1 < len(char_list):
-            i += 1
-            t = char_list[i]
-
-            if t.char == '\n':
-                pos_x = 0
-                pos_y += 1
-                if pos_y == len(buf):
-                    buf.append([None for x in range(self.row_len)])
-                    self._line_wrapped_flags.append(False)
-                continue
+        style = (color, bgcolor, bold, underline, reverse)
+        caches = self._char_caches
+        key = (id(color), id(bgcolor), bold, underline, reverse)
+        cache = caches.get(key)
+        if cache is None or len(cache) > _CHAR_CACHE_SIZE:
+            if len(caches) > _CHAR_CACHE_STYLES:
+                caches.clear()
+            cache = caches[key] = {}
+        widths = self._char_width_cache
+        if len(widths) > _CHAR_CACHE_SIZE:
+            widths.clear()
+        chars = set(text)
+        for t in chars.difference(cache):
+            width = widths.get(t)
+            if width is None:
+                width = widths[t] = self.get_char_width(t)
+            cache[t] = Char(t, width, Placeholder.NON, *style)
+        char_list = list(map(cache.__getitem__, text))
+        n = len(char_list)
+
+        # indices of the characters that can't be copied as part of a run of
+        # narrow characters, i.e. linebreaks and wide characters
+        wide = {t for t in chars if cache[t].char_width != 1}
+        if wide:
+            wide.add('\n')
+            stops = [k for k, t in enumerate(text) if t in wide]
+        else:
+            # only linebreaks, let str.find() look for them
+            stops = []
+            k = text.find('\n')
+            while k != -1:
+                stops.append(k)
+                k = text.find('\n', k + 1)
+        stops.append(n)
+
+        with self._buffer_lock:
+            buf = self._buffer
+
+            offset = len(self._buffer) - self.col_len
+            row_len = self.row_len
+
+            if not pos:
+                pos = self._cursor_position
+                pos_x = pos.x
+                pos_y = pos.y
+            else:
+                pos_x = pos.x
+                pos_y = pos.y + offset
 
-            if pos_x + t.char_width > row_len:
-                if do_auto_wrap:
-                    for j in range(row_len - pos_x):
-                        buf[pos_y][pos_x + j] = Char("", 0, Placeholder.LEAD)
+            i = -1
+            while i + 1 < n:
+                i += 1
+                t = char_list[i]
 
+                if t.char == '\n':
+                    # move down over a whole run of linebreaks at once
+                    end = _LINEBREAK_RUN.match(text, i).end()
                     pos_x = 0
-                    pos_y += 1
-                    self._line_wrapped_flags[pos_y - 1] = True
-                    if pos_y == len(buf):
-                        buf.append([None for x in range(self.row_len)])
+                    pos_y += end - i
+                    for k in range(pos_y + 1 - len(buf)):
+                        buf.append(self._new_row())
                         self._line_wrapped_flags.append(False)
-                else:
-                    pos_x = row_len - t.char_width
+                    i = end - 1
+                    continue
 
-            buf[pos_y][pos_x] = t
-            for j in range(1, t.char_width):
-                buf[pos_y][pos_x + j] = Char("", 0, Placeholder.TAIL)
+                if pos_x + t.char_width > row_len:
+                    if do_auto_wrap:
+                        for j in range(row_len - pos_x):
+                            buf[pos_y][pos_x + j] = _LEAD_CHAR
+
+                        pos_x = 0
+                        pos_y += 1
+                        self._line_wrapped_flags[pos_y - 1] = True
+                        if pos_y == len(buf):
+                            buf.append(self._new_row())
+                            self._line_wrapped_flags.append(False)
+                    else:
+                        pos_x = row_len - t.char_width
+
+                if t.char_width == 1:
+                    # copy the run of narrow characters that fits into this row
+                    # with a single slice assignment
+                    end = min(stops[bisect_right(stops, i)], i + row_len - pos_x)
+                    buf[pos_y][pos_x:pos_x + end - i] = char_list[i:end]
+                    pos_x += end - i
+                    i = end - 1
+                    continue
 
-            pos_x += t.char_width  # could result in pos_x == row_len when exiting loop
+                buf[pos_y][pos_x] = t
+                for j in range(1, t.char_width):
+                    buf[pos_y][pos_x + j] = _TAIL_CHAR
 
-        while len(self._buffer) > self.maximum_line_history:
-            buf.popleft()
-            self._line_wrapped_flags.popleft()
-            pos_y -= 1
+                pos_x += t.char_width  # could result in pos_x == row_len when exiting loop
 
-        if set_cursor:
-            # assert pos_x <= row_len
-            self._cursor_position = Position(min(pos_x, row_len-1), pos_y)
+            pos_y -= self._trim_history(buf, self._line_wrapped_flags)
 
-        if reset_offset:
-            self._buffer_display_offset = min(len(self._buffer) - self.col_len,
-                                              self._cursor_position.y)
-            self.update_scroll_position_postponed()
+            if set_cursor:
+                # assert pos_x <= row_len
+                pos_x = min(pos_x, row_len-1)
+                cur = self._cursor_position
+                if cur.x != pos_x or cur.y != pos_y:
+                    self._cursor_position = Position(pos_x, pos_y)
 
-        self._buffer_lock.unlock()
+            if reset_offset:
+                self._buffer_display_offset = min(len(self._buffer) - self.col_len,
+                                                  self._cursor_position.y)
+                self.update_scroll_position_postponed()
         # self._log_buffer()
 
     def write_at_cursor(self, text):
@@ -1186,12 +1475,11 @@ class TerminalBuffer:
     def delete_at_cursor(self):
         pos = self._cursor_position
         # self._log_buffer()
-        self._buffer_lock.lock()
-        pos_x = pos.x
-        pos_y = pos.y
+        with self._buffer_lock:
+            pos_x = pos.x
+            pos_y = pos.y
 
-        self._buffer[pos_y][pos_x] = None
-        self._buffer_lock.unlock()
+            self._buffer[pos_y][pos_x] = None
 
         # self._log_buffer()
 
@@ -1200,66 +1488,79 @@ class TerminalBuffer:
         cur_pos = self._cursor_position
         offset = self._buffer_display_offset
 
+        # cells are cleared a row (or the part of a row) at a time by slice
+        # assignment, rather than one by one
+        row_len = self.row_len
+        blank = self._blank_template()
+        cur_x = min(cur_pos.x, row_len)
+
         if mode == 0:
-            for x in range(cur_pos.x, self.row_len):
-                buf[cur_pos.y][x] = None
+            if cur_x < row_len:
+                buf[cur_pos.y][cur_x:row_len] = blank[cur_x:]
 
             for y in range(cur_pos.y + 1, offset + self.col_len):
-                for x in range(self.row_len):
-                    buf[y][x] = None
+                buf[y][:row_len] = blank
         elif mode == 1:
             for y in range(offset, cur_pos.y):
-                for x in range(self.row_len):
-                    buf[y][x] = None
+                buf[y][:row_len] = blank
 
-            for x in range(cur_pos.x):
-                buf[cur_pos.y][x] = None
+            if cur_x:
+                buf[cur_pos.y][:cur_x] = blank[:cur_x]
         else:
             for y in range(offset, offset + self.col_len):
-                for x in range(self.row_len):
-                    buf[y][x] = None
+                buf[y][:] = blank
 
     def erase_line(self, mode=3):
         buf = self._buffer
         cur_pos = self._cursor_position
 
+        row_len = self.row_len
+        blank = self._blank_template()
+        cur_x = min(cur_pos.x, row_len)
+
         if mode == 0:
-            for x in range(cur_pos.x, self.row_len):
-                buf[cur_pos.y][x] = None
+            if cur_x < row_len:
+                buf[cur_pos.y][cur_x:row_len] = blank[cur_x:]
         elif mode == 1:
-            for x in range(cur_pos.x):
-                buf[cur_pos.y][x] = None
+            if cur_x:
+                buf[cur_pos.y][:cur_x] = blank[:cur_x]
         else:
-            for x in range(self.row_len):
-                buf[cur_pos.y][x] = None
+            buf[cur_pos.y][:] = blank
 
     def delete_line(self, lines=1):
-        buf = self._buffer
-        self._buffer_lock.lock()
-        cur_pos = self._cursor_position
+        with self._buffer_lock:
+            buf = self._buffer
+            cur_pos = self._cursor_position
 
-        pos_x = 0
-        pos_y = min(cur_pos.y - lines, 0)
+            pos_x = 0
+            pos_y = max(cur_pos.y - lines, 0)
 
-        self._buffer_display_offset = min(self._buffer_display_offset - lines, 0)
+            self._buffer_display_offset = max(self._buffer_display_offset - lines, 0)
 
-        for y in reversed(range(min(cur_pos.y - lines + 1, 0), cur_pos.y + 1)):
-            del buf[y]
+            # drop the rows (and their wrap flags) at once
+            first = max(cur_pos.y - lines + 1, 0)
+            del buf[first:cur_pos.y + 1]
+            del self._line_wrapped_flags[first:cur_pos.y + 1]
 
-        if self._buffer_display_offset > len(self._buffer):
-            self._buffer_display_offset = max(len(self._buffer) - 1, 0)
+            # keep at least a screenful of rows in the buffer
+            while len(buf) < self.col_len:
+                buf.append(self._new_row())
+                self._line_wrapped_flags.append(False)
 
-            self.update_scroll_position_postponed()
+            if self._buffer_display_offset > len(self._buffer):
+                self._buffer_display_offset = max(len(self._buffer) - 1, 0)
 
-        self._cursor_position = Position(pos_x, pos_y)
+                self.update_scroll_position_postponed()
 
-        self._buffer_lock.unlock()
+            self._cursor_position = Position(pos_x, pos_y)
 
     def toggle_alt_screen(self, on=True):
         if on:
             # save current buffer
-            self._alt_buffer = deepcopy(self._buffer)
-            self._alt_line_wrapped_flags = deepcopy(self._line_wrapped_flags)
+            # clear_buffer() below puts other lists in place, so the current
+            # ones are kept as they are instead of being copied
+            self._alt_buffer = self._buffer
+            self._alt_line_wrapped_flags = self._line_wrapped_flags
             self._alt_buffer_display_offset = self._buffer_display_offset
 
             self.clear_buffer()
@@ -1268,6 +1569,12 @@ class TerminalBuffer:
             if not self._alt_buffer:
                 return
 
+            # the rows of the alt screen are reused for the next screen
+            # cleared, e.g. when entering the alt screen again
+            room = self.col_len - len(self._spare_rows)
+            if room > 0:
+                self._spare_rows.extend(self._buffer[:room])
+
             self._buffer = self._alt_buffer
             self._line_wrapped_flags = self._alt_line_wrapped_flags
             self._buffer_display_offset = self._alt_buffer_display_offset
@@ -1299,36 +1606,35 @@ class TerminalBuffer:
         self.auto_wrap_enabled = on
 
     def insert_space(self, num):
-        self._buffer_lock.lock()
-
-        cur_x = self._cursor_position.x
-        cur_y = self._cursor_position.y
-
-        space_left = self.row_len - cur_x
+        with self._buffer_lock:
+            cur_x = self._cursor_position.x
+            cur_y = self._cursor_position.y
 
-        if num >= space_left:
-            self._buffer[cur_y][cur_x:] = [None] * space_left
-            return
+            space_left = self.row_len - cur_x
 
-        to_move = self._buffer[cur_y][cur_x+num]
-        # the first character to move
+            if num >= space_left:
+                self._buffer[cur_y][cur_x:] = [None] * space_left
+                return
 
-        if to_move and to_move.placeholder == Placeholder.TAIL:
-            self._buffer[cur_y][cur_x-num-1] = None
+            to_move = self._buffer[cur_y][cur_x+num]
+            # the first character to move
 
-        self._buffer[cur_y][cur_x+num:self.row_len] = self._buffer[cur_y][cur_x:self.row_len-num]
-        self._buffer[cur_y][cur_x:cur_x+num] = [None]*num
+            if to_move and to_move.placeholder == Placeholder.TAIL:
+                self._buffer[cur_y][cur_x-num-1] = None
 
-        self._buffer_lock.unlock()
+            self._buffer[cur_y][cur_x+num:self.row_len] = self._buffer[cur_y][cur_x:self.row_len-num]
+            self._buffer[cur_y][cur_x:cur_x+num] = [None]*num
 
     # ==========================
     #       CURSOR CONTROL
     # ==========================
 
     def set_cursor_position(self, x, y):
-        self._cursor_position = Position(
-            *self._move_screen_with_pos(x, y)
-        )
+        x, y = self._move_screen_with_pos(x, y)
+        # Position is immutable, only allocate a new one if the cursor moved
+        cur = self._cursor_position
+        if cur.x != x or cur.y != y:
+            self._cursor_position = Position(x, y)
 
     def set_cursor_on_screen_position(self, x, y):
         pos_y = self._buffer_display_offset + y
@@ -1336,26 +1642,15 @@ class TerminalBuffer:
         self.set_cursor_position(pos_x, pos_y)
 
     def _keep_pos_in_screen(self, x, y):
-        if y < self._buffer_display_offset:
-            y = self._buffer_display_offset
-        elif y >= self._buffer_display_offset + self.col_len:
-            y = self._buffer_display_offset + self.col_len - 1
-
-        if x < 0:
-            x = 0
-        elif x >= self.row_len:
-            x = self.row_len - 1
-
-        return x, y
+        offset = self._buffer_display_offset
+        return (min(max(x, 0), self.row_len - 1),
+                min(max(y, offset), offset + self.col_len - 1))
 
     def _move_screen_with_pos(self, x, y):
-        while x < 0:
-            x = self.row_len + x
-            y -= 1
-
-        while x >= self.row_len:
-            x = x - self.row_len
-            y += 1
+        if not 0 <= x < self.row_len:
+            # wrap x into the row, moving y by the number of rows passed
+            dy, x = divmod(x, self.row_len)
+            y += dy
 
         y = max(y, 0)
 
@@ -1363,8 +1658,8 @@ class TerminalBuffer:
             self._buffer_display_offset = y
             self.update_scroll_position_postponed()
 
-        while y >= len(self._buffer):
-            self._buffer.append([None for x in range(self.row_len)])
+        for i in range(y + 1 - len(self._buffer)):
+            self._buffer.append(self._new_row())
             self._line_wrapped_flags.append(False)
 
         if y >= self._buffer_display_offset + self.col_len:
@@ -1375,17 +1670,13 @@ class TerminalBuffer:
 
     def backspace(self, count=1):
         x = self._cursor_position.x - count
-        self.set_cursor_position(
-            *self._move_screen_with_pos(x, self._cursor_position.y)
-        )
+        self.set_cursor_position(x, self._cursor_position.y)
 
     def linefeed(self):
         y = self._cursor_position.y + 1
         x = 0
 
-        self.set_cursor_position(
-            *self._move_screen_with_pos(x, y)
-        )
+        self.set_cursor_position(x, y)
 
     def carriage_feed(self):
         y = self._cursor_position.y
@@ -1415,7 +1706,7 @@ class TerminalBuffer:
     def report_cursor_pos(self):
         x = self._cursor_position.x + 1
         y = self._cursor_position.y - self._buffer_display_offset + 1
-        self.stdin_callback(f"\x1b[{y};{x}R".encode("utf-8"))
+        self.stdin_callback(b"\x1b[%d;%dR" % (y, x))
 
     # ==========================
     #      USER INPUT EVENT
@@ -1429,84 +1720,96 @@ class TerminalBuffer:
         # Note that this function accepts UTF-8 only (since python use utf-8).
         # Normally modern programs will determine the encoding of its stdout
         # from env variable LC_CTYPE and for most systems, it is set to utf-8.
-        self._stdout_string(string)
+        self._stdout_string(to_bytes(string))
 
     def _stdout_string(self, string: bytes):
         # ret: need_draw
         need_draw = False
         tst_buf = ""
 
-        i = -1
-
-        while i + 1 < len(string):
-            i += 1
-            char = string[i]
+        # avoid attribute lookups for every byte
+        ep_feed = self.escape_processor.feed
+        write_at_cursor = self.write_at_cursor
+        n = len(string)
 
-            try:
-                # self.clear_input_buffer()
-                ret = self.escape_processor.input(char)
-                if ret == 0:
-                    if tst_buf:
-                        self.write_at_cursor(tst_buf)
-                        tst_buf = ""
-                    continue
+        i = 0
 
-                if ret == 1:
-                    need_draw = True
-                    continue
+        while i < n:
+            # feed the escape sequence that is in progress or begins here
+            # to the escape processor
+            j = ep_feed(string, i)
+            if j != i:
+                need_draw = True
+                i = j
+                continue
 
-                if ret == -1:
-                    if char == ControlChar.BS.value:
-                        if tst_buf:
-                            self.write_at_cursor(tst_buf)
-                            tst_buf = ""
-                        self.backspace()
-                    elif char == ControlChar.CR.value:
+            # the bytes until the next ESC can't be part of an escape
+            # sequence, handle them without going through the state machine
+            end = string.find(b"\x1b", i)
+            if end == -1:
+                end = n
+            need_draw = True
+
+            while i < end:
+                char = string[i]
+                cls = _OUTPUT_CLASS[char]
+                if cls == _CONTROL:
+                    # tested in order of how common they are in output
+                    if char == _LF:
+                        # write() breaks the line itself, so the text
+                        # around a linefeed is written in one call
+                        tst_buf += "\n"
+                    elif char == _CR:
                         if tst_buf:
-                            self.write_at_cursor(tst_buf)
+                            write_at_cursor(tst_buf)
                             tst_buf = ""
                         self.carriage_feed()
-
-                    elif char == ControlChar.LF.value:
+                    elif char == _BS:
                         if tst_buf:
-                            self.write_at_cursor(tst_buf)
+                            write_at_cursor(tst_buf)
                             tst_buf = ""
-                        self.write_at_cursor("\n")
-                    elif char == ControlChar.TAB.value:
-                        tst_buf += "        "
-                    elif char == ControlChar.BEL.value:
+                        # move the cursor once for a run of backspaces
+                        run = _BS_RUN.match(string, i, end)
+                        self.backspace(run.end() - i)
+                        i = run.end()
+                        continue
+                    elif char == _BEL:
                         # TODO: visual bell
                         pass
+                elif cls:
+                    # printable ASCII, TAB or the leading byte of a
+                    # multi-byte utf-8 character, consume the whole run of
+                    # text and decode it at once. a TAB is written as 8
+                    # spaces.
+                    run = _TEXT_RUN.match(string, i, end)
+                    if run:
+                        tst_buf += run.group().decode("utf-8").replace(
+                            "\t", "        ")
+                        i = run.end()
+                        continue
+                    # not a valid utf-8 character, drop its leading byte
+                    self.logger.debug("invalid utf-8 sequence at %s",
+                                      string[i:i+4])
+                else:
+                    tst_buf += chr(char)
+                i += 1
 
-                    # determing utf-8 char width
-                    elif char & 0xc0 == 0xc0:  # 2-byte, 3-byte, or 4-byte
-                        if char & 0xe0 == 0xe0:  # 3-byte or 4-byte
-                            if char & 0xf0 == 0xf0:  # 4-byte
-                                tst_buf += string[i:i+4].decode("utf-8")
-                                i += 3
-                            else:  # 3-byte
-                                tst_buf += string[i:i+3].decode("utf-8")
-                                i += 2
-                        else:  # 2-byte
-                                tst_buf += string[i:i+2].decode("utf-8")
-                                i += 1
-                    else:
-                        tst_buf += chr(char)
-
-                    need_draw = True
-            except ValueError as e:
-                self.logger.debug(e)
-
-        if tst_buf:
-            self.write_at_cursor(tst_buf)
+            if tst_buf:
+                write_at_cursor(tst_buf)
+                tst_buf = ""
 
         return need_draw
 
     def input(self, char):
-        if isinstance(char, bytes):
-            self.stdin_callback(char)
-        elif isinstance(char, int):
-            self.stdin_callback(bytes([char]))
+        # char: either a single character as int, or bytes. A whole run of
+        # text (e.g. pasted text, or text committed by an input method) is
+        # passed as bytes and sent to the program at once.
+        if isinstance(char, int):
+            char = bytes([char])
+        elif not isinstance(char, bytes):
+            return
+
+        self.stdin_callback(char)
 
         # naive implementation for cooked mode of the terminal
         # use it if you don't want to use system's cooked mode
@@ -9,6 +9,25 @@ from abc import ABC, abstractmethod
 from .terminal_io import TerminalIO
 
 
+def _utf8_cut(buf, end):
+    # ret: the position in _buf_ before the utf-8 character cut off by the
+    #      end of data at _end_, or _end_ if the last character is complete
+    for i in range(end - 1, max(end - 4, 0) - 1, -1):
+        c = buf[i]
+        if c & 0xc0 != 0x80:
+            # the leading byte of the last character
+            if c >= 0xf0:
+                length = 4
+            elif c >= 0xe0:
+                length = 3
+            elif c >= 0xc0:
+                length = 2
+            else:
+                length = 1
+            return i if end - i < length else end
+    return end
+
+
 class TerminalPOSIXIO(TerminalIO, ABC):
     # This class provides io functions that communciate with the Terminal
     # and the pty (pseudo-tty) of a program.
@@ -27,7 +46,9 @@ class TerminalPOSIXIO(TerminalIO, ABC):
         self.fd = -1
         self.running = False
 
-        self._read_buf = b""
+        # reads from the pty go into this buffer, so that each read only
+        # allocates the bytes actually read rather than the whole chunk
+        self._read_buf = bytearray(65536)
 
         self.terminated_callback = lambda: None
         self.stdout_callback = lambda bs: None
@@ -110,7 +131,7 @@ class TerminalPOSIXIO(TerminalIO, ABC):
             self.terminated_callback()
 
     def write(self, buffer: bytes):
-        self.logger.debug("stdin: " + str(buffer))
+        self.logger.debug("stdin: %s", buffer)
         if not self.running:
             return
 
@@ -123,6 +144,11 @@ class TerminalPOSIXIO(TerminalIO, ABC):
     def _read_loop(self):
         # read loop to be run in a separated thread
         fd = self.fd
+        read_buf = self._read_buf
+        read_view = memoryview(read_buf)
+        # a read can end in the middle of a utf-8 character, its first bytes
+        # are kept at the start of _read_buf and completed by the next read
+        tail = 0
         poll = select.poll()
         poll.register(fd, select.POLLIN | select.POLLHUP | select.POLLERR)
 
@@ -131,13 +157,27 @@ class TerminalPOSIXIO(TerminalIO, ABC):
                 fds = poll.poll(50)  # poll for 50ms
                 if not fds:
                     continue
-                buf = os.read(fd, 1032)
-                # 1032 % 4 == 1032 % 3 == 0, avoid truncating utf-8 char
-
-                if len(buf) == 0:
-                    break
-
-                self.stdout_callback(buf)
+                # keep reading as long as the buffer gets filled, instead of
+                # polling again between the reads of a burst of output
+                while True:
+                    size = len(read_buf) - tail
+                    try:
+                        n = os.readv(fd, [read_view[tail:]])
+                    except BlockingIOError:
+                        break
+
+                    if n == 0:
+                        return
+
+                    end = tail + n
+                    cut = _utf8_cut(read_buf, end)
+                    if cut:
+                        self.stdout_callback(bytes(read_view[:cut]))
+                    tail = end - cut
+                    read_view[:tail] = read_buf[cut:end]
+
+                    if n < size:
+                        break
         except OSError:
             pass
         finally:
@@ -152,16 +192,18 @@ class TerminalPOSIXIO(TerminalIO, ABC):
             os.kill(self.pid, signal.SIGTERM)
 
             def _check_killed():
-                time.sleep(3000)
                 if self.is_alive():
                     os.kill(self.pid, signal.SIGKILL)
 
-            threading.Thread(target=_check_killed, daemon=True).start()
+            # kill it for good if it is still there 3 seconds later
+            timer = threading.Timer(3, _check_killed)
+            timer.daemon = True
+            timer.start()
             self.running = False
 
     def is_alive(self):
         try:
-            os.kill(self.pif, 0)
+            os.kill(self.pid, 0)
             return True
         except OSError:
             self.running = False
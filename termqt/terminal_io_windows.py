@@ -1,4 +1,5 @@
 import os
+import time
 import logging
 import threading
 import winpty
@@ -60,7 +61,7 @@ class TerminalWinptyIO(TerminalIO):
             self.terminated_callback()
 
     def write(self, buffer: bytes):
-        self.logger.debug("stdin: " + str(buffer))
+        self.logger.debug("stdin: %s", buffer)
         if not self.running:
             return
         try:
@@ -73,13 +74,17 @@ class TerminalWinptyIO(TerminalIO):
         # read loop to be run in a separated thread
         try:
             while self.running:
-                buf = self.pty_process.read()
+                # read as much as is available, rather than winpty's default
+                # of 1024 characters at a time
+                buf = self.pty_process.read(65536)
                 if not buf:
-                    continue
-                elif len(buf) == 0:
+                    # nothing to read, don't spin on the pty
+                    time.sleep(0.01)
                     continue
                 if isinstance(buf, str):
-                    self.stdout_callback(bytes(buf, 'utf-8'))
+                    # winpty hands out decoded text, encode it straight back
+                    # without failing on unpaired surrogates
+                    self.stdout_callback(buf.encode("utf-8", "surrogatepass"))
                 else:
                     self.stdout_callback(buf)
         finally:
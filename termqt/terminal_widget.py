@@ -1,14 +1,16 @@
 import logging
 import math
+import time
+import threading
 from enum import Enum
 
 from qtpy.QtWidgets import QWidget, QScrollBar, QMenu, QAction, QApplication
 from qtpy.QtGui import (QPainter, QColor, QPalette, QFontDatabase,
                       QPen, QFont, QFontInfo, QFontMetrics, QPixmap)
-from qtpy.QtCore import Qt, QTimer, QMutex, Signal
+from qtpy.QtCore import Qt, QTimer, QRect, Signal
 
 from .terminal_buffer import Position, TerminalBuffer, DEFAULT_BG_COLOR, \
-    DEFAULT_FG_COLOR, ControlChar, Placeholder
+    DEFAULT_FG_COLOR, ControlChar, Placeholder, to_bytes
 from qtpy import QT_VERSION
 from .colors import colors16
 
@@ -19,6 +21,64 @@ class CursorState(Enum):
     UNFOCUSED = 3
 
 
+# how long (in ms) the blinking cursor stays visible/hidden
+_CURSOR_ON_INTERVAL = 400
+_CURSOR_OFF_INTERVAL = 250
+
+# minimum time (in ms) between two repaints of the canvas caused by output
+_REPAINT_INTERVAL = 16
+
+# maximum number of pre-rendered glyphs kept by Terminal's glyph cache
+_GLYPH_CACHE_SIZE = 4096
+
+
+def _rgba(color):
+    # colors of a Char are either a QColor or a Qt.GlobalColor such as
+    # DEFAULT_FG_COLOR
+    if isinstance(color, QColor):
+        return color.rgba()
+    return QColor(color).rgba()
+
+
+# rgba value of the color screen lines are cleared with
+_DEFAULT_BG_RGBA = _rgba(DEFAULT_BG_COLOR)
+
+# shared QColor objects of the rgba values runs of blank cells are filled
+# with, see _fill_color()
+_fill_colors = {}
+
+
+def _fill_color(rgba):
+    # ret: the QColor of rgba value _rgba_
+    color = _fill_colors.get(rgba)
+    if color is None:
+        color = _fill_colors[rgba] = QColor.fromRgba(rgba)
+    return color
+
+
+# what _paint_buffer() remembers of a screen line that has to be painted
+# again, it never matches the line's current content
+_STALE_LINE = (None, None)
+
+
+# escape sequences sent for cursor keys, regardless of the modifiers
+_CURSOR_KEYS = {
+    Qt.Key_Up: b'\x1b[A',
+    Qt.Key_Down: b'\x1b[B',
+    Qt.Key_Right: b'\x1b[C',
+    Qt.Key_Left: b'\x1b[D',
+}
+
+# control characters sent for keys pressed without modifiers
+_PLAIN_KEYS = {
+    Qt.Key_Enter: ControlChar.CR.value,
+    Qt.Key_Return: ControlChar.CR.value,
+    Qt.Key_Delete: ControlChar.BS.value,
+    Qt.Key_Backspace: ControlChar.BS.value,
+    Qt.Key_Escape: ControlChar.ESC.value,
+}
+
+
 class Terminal(TerminalBuffer, QWidget):
 
     # Terminal widget.
@@ -38,7 +98,7 @@ class Terminal(TerminalBuffer, QWidget):
 
     # internal signal for triggering stdout routine for buffering and
     # painting. Note: Use stdout() method.
-    _stdout_sig = Signal(bytes)
+    _stdout_sig = Signal()
 
     # update scroll bar
     update_scroll_sig = Signal()
@@ -66,8 +126,27 @@ class Terminal(TerminalBuffer, QWidget):
 
         # we paint everything to the pixmap first then paint this pixmap
         # on paint event. This allows us to partially update the canvas.
+        # Note: the canvas is only ever painted from the GUI thread (QPixmap
+        # can't be used from others), which serializes the painting, so it
+        # needs no lock.
         self._canvas = QPixmap(width, height)
-        self._painter_lock = QMutex()
+        # (width, height, device pixel ratio) _paint_buffer() made the
+        # canvas with, it is only made again when these change
+        self._canvas_size = None
+
+        # pixmaps of the characters painted so far, keyed by the character
+        # and the colors and style it was painted with. Painting a cell is
+        # then a single blit instead of a fillRect() and a drawText().
+        self._glyph_cache = {}
+        # the fonts glyphs are rendered with, see _apply_font_settings()
+        self._fonts = None
+
+        # copies of the rows painted on each line of the canvas together with
+        # the selected columns, None for lines left blank. _paint_buffer()
+        # only paints the lines whose row or selection has changed since.
+        self._painted_lines = []
+        # lines of the canvas the cursor has been painted on
+        self._cursor_lines = set()
 
         self._width = width
         self._height = height
@@ -98,9 +177,9 @@ class Terminal(TerminalBuffer, QWidget):
         self.total_repaint_sig.connect(self._canvas_repaint)
 
         # intializing blinking cursor
-        self._cursor_blinking_lock = QMutex()
+        # Note: the blinking state is only touched from the GUI thread (the
+        # timer, focus events and resizing), so it needs no lock.
         self._cursor_blinking_state = CursorState.ON
-        self._cursor_blinking_elapse = 0
         self._cursor_blinking_timer = QTimer()
         self._cursor_blinking_timer.timeout.connect(self._blink_cursor)
         self._switch_cursor_blink(state=CursorState.ON, blink=True)
@@ -115,6 +194,24 @@ class Terminal(TerminalBuffer, QWidget):
         # self.echo = True
         # self.canonical_mode = True
 
+        # repaints requested while a stdout batch is being processed are
+        # coalesced into a single _canvas_repaint(), which happens on the
+        # next event loop iteration, or once _REPAINT_INTERVAL has passed
+        # since the previous one, so that a flood of output is painted at
+        # most once per frame.
+        self._repaint_pending = False
+        self._last_repaint = 0
+
+        # wheel rotation not yet turned into scrolling
+        self._wheel_delta = 0
+
+        # output waiting to be processed on the GUI thread. stdout() is
+        # usually called from the IO thread, only the chunk that finds the
+        # list empty emits _stdout_sig, and _stdout() then takes all the
+        # chunks that arrived in the meantime at once.
+        self._stdout_pending = []
+        self._stdout_pending_lock = threading.Lock()
+
         self._stdout_sig.connect(self._stdout)
         self.resize(width, height)
 
@@ -122,16 +219,24 @@ class Terminal(TerminalBuffer, QWidget):
         # Number of lines to scroll per wheel step
         lines_per_step = 3
 
+        # One wheel step is 120 units of angleDelta(). Touchpads report much
+        # smaller deltas, they are summed up until they make a whole step.
+        self._wheel_delta += event.angleDelta().y()
+        steps = int(self._wheel_delta / 120)
+        if not steps:
+            return
+        self._wheel_delta -= steps * 120
+
         # Calculate the scroll amount (positive for scroll up, negative for down)
-        scroll_amount = event.angleDelta().y() // 120 * lines_per_step
+        scroll_amount = steps * lines_per_step
 
         # Update buffer display offset
         self._buffer_display_offset = max(0, min(
             self._buffer_display_offset - scroll_amount, len(self._buffer) - self.col_len))
 
-        # Update the terminal display
-        self._paint_buffer()
-        self.repaint()
+        # Update the terminal display, a burst of wheel events is painted
+        # once per frame
+        self._request_repaint()
 
         # Update scroll bar position if it exists
         if self.scroll_bar:
@@ -244,6 +349,20 @@ class Terminal(TerminalBuffer, QWidget):
         self.char_width = self.metrics.horizontalAdvance("A")
         self.char_height = self.metrics.height()
         self.line_height = int(self.char_height * self._line_height_factor)
+        # widths of the cached characters were measured with the old font
+        self._char_caches.clear()
+        self._char_width_cache.clear()
+        self._glyph_cache.clear()
+        self._painted_lines = []
+
+        # copies of the font in each style, indexed by bold << 1 | underline.
+        # self.font is also used to paint the cursor, it is left plain.
+        self._fonts = []
+        for i in range(4):
+            ft = QFont(font)
+            ft.setBold(bool(i & 2))
+            ft.setUnderline(bool(i & 1))
+            self._fonts.append(ft)
 
         self.logger.info(f"font: Font {info.family()} selected, character size {self.char_width}x{self.char_height}.")
 
@@ -257,43 +376,71 @@ class Terminal(TerminalBuffer, QWidget):
     # ==========================
 
     def paintEvent(self, event):
-        self._painter_lock.lock()
         _qp = QPainter(self)
-        _qp.setRenderHint(QPainter.Antialiasing)
-        _qp.drawPixmap(
-            int(self._padding/2),
-            int(self._padding/2),
-            self._canvas
-        )
+
+        # only copy the part of the canvas that has to be painted again
+        pad = int(self._padding/2)
+        dpr = self._canvas.devicePixelRatio()
+        canvas_rect = QRect(pad, pad, int(self._canvas.width() / dpr),
+                            int(self._canvas.height() / dpr))
+        rect = event.rect().intersected(canvas_rect)
+        if not rect.isEmpty():
+            # the source rectangle is in pixels of the canvas
+            _qp.drawPixmap(rect.topLeft(), self._canvas,
+                           QRect(int((rect.x() - pad) * dpr),
+                                 int((rect.y() - pad) * dpr),
+                                 int(rect.width() * dpr),
+                                 int(rect.height() * dpr)))
         QWidget.paintEvent(self, event)
-        self._painter_lock.unlock()
 
     def _paint_buffer(self):
-        self._painter_lock.lock()
-
-        self._canvas = QPixmap(self.row_len * self.char_width * self.dpr,
-                               int((self.col_len + 0.2)
-                                   * self.line_height * self.dpr))
-        self._canvas.setDevicePixelRatio(self.dpr)
-
-        qp = QPainter(self._canvas)
-        qp.fillRect(self.rect(), self._bg_color)
+        self._prepare_canvas()
         if not self._buffer:
             return
 
+        qp = QPainter(self._canvas)
+        self._paint_buffer_into(qp)
+        qp.end()
+
+    def _prepare_canvas(self):
+        # Make a new canvas if the size of the terminal has changed, and mark
+        # the lines the cursor was painted on for repainting.
+        # Note: no QPainter may be active on the canvas.
+        dpr = self.dpr
+        canvas_size = (self.row_len * self.char_width * dpr,
+                       int((self.col_len + 0.2) * self.line_height * dpr),
+                       dpr)
+        painted = self._painted_lines
+        if canvas_size != self._canvas_size or len(painted) != self.col_len:
+            # start over with a blank canvas
+            self._canvas = QPixmap(canvas_size[0], canvas_size[1])
+            self._canvas.setDevicePixelRatio(dpr)
+            self._canvas.fill(DEFAULT_BG_COLOR)
+            self._canvas_size = canvas_size
+            painted = self._painted_lines = [None] * self.col_len
+            self._cursor_lines.clear()
+
+        # the cell under the cursor has been painted over
+        for ln in self._cursor_lines:
+            if 0 <= ln < self.col_len:
+                painted[ln] = _STALE_LINE
+        self._cursor_lines.clear()
+
+    def _paint_buffer_into(self, qp):
+        # Paint the lines of the buffer that have changed with painter _qp_
+        # on the canvas prepared by _prepare_canvas().
         cw = self.char_width
         ch = self.char_height
         lh = self.line_height
-        ft = self.font
+        width = self.row_len * cw
+        painted = self._painted_lines
+
         fg_color = self._fg_color
 
         ht = 0
 
         offset = self._buffer_display_offset
 
-        qp.fillRect(self.rect(), DEFAULT_BG_COLOR)
-
-        in_selection = False
         start_col = start_row = end_col = end_row = None
 
         if self._selection_end:
@@ -305,60 +452,130 @@ class Terminal(TerminalBuffer, QWidget):
                 start_row, end_row = end_row, start_row
                 start_col, end_col = end_col, start_col
 
-        for ln in range(self.col_len):
-            real_ln = ln + offset
-            if real_ln < 0 or real_ln >= len(self._buffer):
-                break
+        if len(self._glyph_cache) > _GLYPH_CACHE_SIZE:
+            self._glyph_cache.clear()
 
-            row = self._buffer[real_ln]
+        # the cells of the Char objects met during this paint, by id(). Char
+        # objects are shared by the cells written in the same style, so most
+        # cells find their glyph here without building a glyph cache key.
+        # the ids stay valid since the buffer holds on to the objects.
+        plain_cells = {}
+        selected_cells = {}
+        # the colors of the cells are mostly the same few palette entries,
+        # their rgba values are looked up once per paint
+        rgbas = {}
+        line_bg = _DEFAULT_BG_RGBA
 
+        for ln in range(self.col_len):
+            real_ln = ln + offset
             ht += lh
 
-            in_selection_edge_row = False
+            if real_ln < 0 or real_ln >= len(self._buffer):
+                if painted[ln] is not None:
+                    qp.fillRect(0, int(ht - 0.8*ch), width, lh,
+                                DEFAULT_BG_COLOR)
+                    painted[ln] = None
+                continue
 
-            if not in_selection and start_row is not None \
-                    and start_row == real_ln:
-                if start_col > 0:
-                    in_selection_edge_row = True
-                else:
-                    in_selection = True
-            if in_selection:
-                if end_row == real_ln:
-                    if end_col < self.row_len - 1:
-                        in_selection_edge_row = True
-                elif end_row < real_ln:
-                    in_selection = False
+            row = self._buffer[real_ln]
 
+            # the selected columns of this line
+            if start_row is not None and start_row <= real_ln <= end_row:
+                sel_from = start_col if real_ln == start_row else 0
+                sel_to = end_col + 1 if real_ln == end_row else self.row_len
+                selection = (sel_from, sel_to)
+            else:
+                sel_from = sel_to = 0
+                selection = None
+
+            snapshot = painted[ln]
+            if snapshot is not None and snapshot[1] == selection \
+                    and snapshot[0] == row:
+                continue
+            painted[ln] = (row[:], selection)
+
+            y = int(ht - 0.8*ch)
+            qp.fillRect(0, y, width, lh, DEFAULT_BG_COLOR)
+
+            # blank cells are not blitted, a run of them in the same color
+            # is filled at once, or left alone in the color of the line
+            run_start = 0
+            run_bg = None
             for cn, c in enumerate(row):
                 if c:
-                    if in_selection_edge_row:
-                        if not in_selection and cn == start_col:
-                            in_selection = True
-                            in_selection_edge_row = (end_row == real_ln)
-                        elif in_selection and cn == end_col + 1:
-                            in_selection = False
-                            in_selection_edge_row = False
-
-                    bgcolor = c.bg_color if not in_selection else self.selection_color
-
-                    ft.setBold(c.bold)
-                    ft.setUnderline(c.underline)
-                    qp.setFont(ft)
-
                     if c.placeholder == Placeholder.NON:
-                        if not c.reverse or in_selection:
-                            qp.fillRect(cn*cw, int(ht - 0.8*ch),
-                                        cw*c.char_width, lh, bgcolor)
-                            qp.setPen(c.color)
-                        else:
-                            qp.fillRect(cn*cw, int(ht - 0.8*ch),
-                                        cw*c.char_width, lh, c.color)
-                            qp.setPen(c.bg_color)
-
-                        qp.drawText(cn*cw, ht, c.char)
+                        selected = sel_from <= cn < sel_to
+                        cells = selected_cells if selected else plain_cells
+                        cell = cells.get(id(c))
+                        if cell is None:
+                            cell = cells[id(c)] = self._cell(c, selected, rgbas)
+                        glyph, bg = cell
+                    else:
+                        glyph = bg = None
+                elif run_bg == line_bg:
+                    # an empty cell continuing a run in the color of the line
+                    continue
+                else:
+                    glyph, bg = None, line_bg
+
+                if bg != run_bg:
+                    if run_bg is not None and run_bg != line_bg:
+                        qp.fillRect(run_start*cw, y, (cn - run_start)*cw, lh,
+                                    _fill_color(run_bg))
+                    run_start = cn
+                    run_bg = bg
+
+                if glyph is not None:
+                    qp.drawPixmap(cn*cw, y, glyph)
+
+            if run_bg is not None and run_bg != line_bg:
+                qp.fillRect(run_start*cw, y, (len(row) - run_start)*cw, lh,
+                            _fill_color(run_bg))
+
+    def _cell(self, c, selected, rgbas):
+        # ret: (glyph, None) with the pixmap of Char _c_ in the glyph cache,
+        #      rendered if needed, or (None, bg) if the cell is blank and only
+        #      shows its background color _bg_, as an rgba value
+        # args: rgbas: rgba values of the colors met during the paint, by id()
+        if selected:
+            fg, bg = c.color, self.selection_color
+        elif not c.reverse:
+            fg, bg = c.color, c.bg_color
+        else:
+            fg, bg = c.bg_color, c.color
+
+        bg_rgba = rgbas.get(id(bg))
+        if bg_rgba is None:
+            bg_rgba = rgbas[id(bg)] = _rgba(bg)
+        if c.char == " " and not c.underline:
+            return None, bg_rgba
+
+        fg_rgba = rgbas.get(id(fg))
+        if fg_rgba is None:
+            fg_rgba = rgbas[id(fg)] = _rgba(fg)
+
+        key = (c.char, c.char_width, fg_rgba, bg_rgba, c.bold, c.underline)
+        glyph = self._glyph_cache.get(key)
+        if glyph is None:
+            glyph = self._glyph_cache[key] = self._render_glyph(c, fg, bg)
+        return glyph, None
+
+    def _render_glyph(self, c, fg, bg):
+        # Paint the cell of Char _c_ with colors _fg_ and _bg_ into a pixmap
+        # of its own, in the same way it would be painted on the canvas.
+        cw = self.char_width
+        lh = self.line_height
+        glyph = QPixmap(cw * c.char_width * self.dpr, lh * self.dpr)
+        glyph.setDevicePixelRatio(self.dpr)
+        glyph.fill(bg)
 
+        qp = QPainter(glyph)
+        qp.setFont(self._fonts[c.bold << 1 | c.underline])
+        qp.setPen(fg)
+        # the cell starts 0.8 * char_height above the baseline
+        qp.drawText(0, math.ceil(0.8 * self.char_height), c.char)
         qp.end()
-        self._painter_lock.unlock()
+        return glyph
 
     def _is_selected(self, col, row):
         if not self._selection_start or not self._selection_end:
@@ -379,7 +596,17 @@ class Terminal(TerminalBuffer, QWidget):
         if not self._buffer:
             return
 
-        self._painter_lock.lock()
+        qp = QPainter(self._canvas)
+        self._paint_cursor_into(qp)
+        qp.end()
+
+    def _paint_cursor_into(self, qp):
+        # Paint the cursor with painter _qp_ on the canvas.
+        line = self._cursor_position.y - self._buffer_display_offset
+        if not 0 <= line < self.col_len:
+            # the cursor is scrolled out of view
+            return
+
         ind_x = self._cursor_position.x
         ind_y = self._cursor_position.y
         # if cursor is at the right edge of screen, display half of it
@@ -392,7 +619,9 @@ class Terminal(TerminalBuffer, QWidget):
         cw = self.char_width
         ch = self.char_height
 
-        qp = QPainter(self._canvas)
+        # _paint_buffer() has to paint this line again to remove the cursor
+        self._cursor_lines.add(line)
+
         fg = DEFAULT_FG_COLOR
         bg = DEFAULT_BG_COLOR
 
@@ -433,16 +662,35 @@ class Terminal(TerminalBuffer, QWidget):
                 else:
                     qp.drawText(x, cy, " ")
 
-        qp.end()
-        self._painter_lock.unlock()
-
     def _canvas_repaint(self):
-        self._paint_buffer()
-        self._paint_cursor()
-        self.repaint()
+        # _paint_buffer() and _paint_cursor() in a single painter session
+        self._prepare_canvas()
+        if self._buffer:
+            qp = QPainter(self._canvas)
+            self._paint_buffer_into(qp)
+            self._paint_cursor_into(qp)
+            qp.end()
+        self.update()
+
+    def _request_repaint(self):
+        # Mark the canvas dirty. Only the first request of a batch schedules
+        # a flush, so a burst of writes results in at most one paint.
+        if not self._repaint_pending:
+            self._repaint_pending = True
+            elapsed = int((time.monotonic() - self._last_repaint) * 1000)
+            QTimer.singleShot(max(0, _REPAINT_INTERVAL - elapsed),
+                              self._flush_repaint)
+
+    def _flush_repaint(self):
+        if self._repaint_pending:
+            self._repaint_pending = False
+            self._last_repaint = time.monotonic()
+            self._canvas_repaint()
 
     def get_char_width(self, t):
-        if len(t.encode("utf-8")) == 1:
+        # TerminalBuffer.write() keeps the widths in _char_width_cache, this
+        # is only called for characters it hasn't seen with the current font
+        if ord(t) < 0x80:
             return 1
         else:
             return math.ceil(self.metrics.horizontalAdvance(t) / self.char_width)
@@ -452,8 +700,6 @@ class Terminal(TerminalBuffer, QWidget):
     # ==========================
 
     def resize(self, width, height):
-        self._save_cursor_state_stop_blinking()
-
         QWidget.resize(self, width, height)
 
         row_len = int((width - self._padding) / self.char_width)
@@ -462,6 +708,14 @@ class Terminal(TerminalBuffer, QWidget):
             self.maximum_line_history
         )
 
+        if self._buffer and row_len == self.row_len \
+                and col_len == self.col_len:
+            # the size in characters is unchanged, or the resizeEvent() sent
+            # by QWidget.resize() above has already dealt with it
+            return
+
+        self._save_cursor_state_stop_blinking()
+
         TerminalBuffer.resize(self, row_len, col_len)
 
         self._paint_buffer()
@@ -470,7 +724,7 @@ class Terminal(TerminalBuffer, QWidget):
 
     def toggle_alt_screen(self, on=True):
         TerminalBuffer.toggle_alt_screen(self, on)
-        self._canvas_repaint()
+        self._request_repaint()
 
     def toggle_alt_screen_save_cursor(self, on=True):
         if on:
@@ -488,43 +742,30 @@ class Terminal(TerminalBuffer, QWidget):
     # ==========================
 
     def _blink_cursor(self):
-        self._cursor_blinking_lock.lock()
-
+        # the timer fires once per phase, its interval is switched to the
+        # length of the next phase
         if self._cursor_blinking_state == CursorState.ON:  # On
-            if self._cursor_blinking_elapse < 400:
-                # 50 is the period of the timer
-                self._cursor_blinking_elapse += 50
-                self._cursor_blinking_lock.unlock()
-                return
-            else:
-                self._cursor_blinking_state = CursorState.OFF
+            self._cursor_blinking_state = CursorState.OFF
+            self._cursor_blinking_timer.setInterval(_CURSOR_OFF_INTERVAL)
         elif self._cursor_blinking_state == CursorState.OFF:  # Off
-            if self._cursor_blinking_elapse < 250:
-                # 50 is the period of the timer
-                self._cursor_blinking_elapse += 50
-                self._cursor_blinking_lock.unlock()
-                return
-            else:
-                self._cursor_blinking_state = CursorState.ON
-
-        self._cursor_blinking_elapse = 0
-        self._cursor_blinking_lock.unlock()
+            self._cursor_blinking_state = CursorState.ON
+            self._cursor_blinking_timer.setInterval(_CURSOR_ON_INTERVAL)
 
         self._paint_cursor()
-        self.repaint()
+        self.update()
 
     def _switch_cursor_blink(self, state, blink=True):
-        self._cursor_blinking_lock.lock()
-
         if state != CursorState.UNFOCUSED and blink:
-            self._cursor_blinking_timer.start(50)
+            self._cursor_blinking_timer.start(
+                _CURSOR_OFF_INTERVAL if state == CursorState.OFF
+                else _CURSOR_ON_INTERVAL
+            )
         else:
             self._cursor_blinking_timer.stop()
         self._cursor_blinking_state = state
 
-        self._cursor_blinking_lock.unlock()
         self._paint_cursor()
-        self.repaint()
+        self.update()
 
     def _save_cursor_state_stop_blinking(self):
         self._saved_cursor_state = self._cursor_blinking_state
@@ -538,22 +779,30 @@ class Terminal(TerminalBuffer, QWidget):
         # Note that this function accepts UTF-8 only (since python use utf-8).
         # Normally modern programs will determine the encoding of its stdout
         # from env variable LC_CTYPE and for most systems, it is set to utf-8.
-        self._stdout_sig.emit(string)
+        string = to_bytes(string)
+        with self._stdout_pending_lock:
+            self._stdout_pending.append(string)
+            if len(self._stdout_pending) > 1:
+                # _stdout() hasn't run for the previous chunk yet
+                return
+        self._stdout_sig.emit()
+
+    def _stdout(self):
+        with self._stdout_pending_lock:
+            pending = self._stdout_pending
+            self._stdout_pending = []
+        if not pending:
+            return
+        string = pending[0] if len(pending) == 1 else b"".join(pending)
 
-    def _stdout(self, string: bytes):
-        # Note that this function accepts UTF-8 only (since python use utf-8).
-        # Normally modern programs will determine the encoding of its stdout
-        # from env variable LC_CTYPE and for most systems, it is set to utf-8.
         self._postpone_scroll_update = True
-        self._buffer_lock.lock()
-        need_draw = self._stdout_string(string)
-        self._buffer_lock.unlock()
+        with self._buffer_lock:
+            need_draw = self._stdout_string(string)
         if need_draw:
             self._postpone_scroll_update = False
             if self._scroll_update_pending:
                 self.update_scroll_position()
-            self._paint_buffer()
-            self.repaint()
+            self._request_repaint()
 
     def focusInEvent(self, event):
         self._switch_cursor_blink(CursorState.ON, True)
@@ -567,89 +816,22 @@ class Terminal(TerminalBuffer, QWidget):
         text = event.text()
         self.reset_selection()
 
-        while True:
-            # This is a one-shot loop, because I want to use 'break'
-            # to jump out of this block
-            if key == Qt.Key_Up:
-                self.input(b'\x1b[A')
-            elif key == Qt.Key_Down:
-                self.input(b'\x1b[B')
-            elif key == Qt.Key_Right:
-                self.input(b'\x1b[C')
-            elif key == Qt.Key_Left:
-                self.input(b'\x1b[D')
-            else:
-                break  # avoid the execution of 'return'
+        seq = _CURSOR_KEYS.get(key)
+        if seq is not None:
+            self.input(seq)
             return
 
         if not modifiers:
-            while True:
-                # This is a one-shot loop, because I want to use 'break'
-                # to jump out of this block
-                if key == Qt.Key_Enter or key == Qt.Key_Return:
-                    self.input(ControlChar.CR.value)
-                elif key == Qt.Key_Delete or key == Qt.Key_Backspace:
-                    self.input(ControlChar.BS.value)
-                elif key == Qt.Key_Escape:
-                    self.input(ControlChar.ESC.value)
-                else:
-                    break  # avoid the execution of 'return'
+            c = _PLAIN_KEYS.get(key)
+            if c is not None:
+                self.input(c)
                 return
         elif modifiers == Qt.ControlModifier or modifiers == Qt.MetaModifier:
-            if key == Qt.Key_A:
-                self.input(ControlChar.SOH.value)
-            elif key == Qt.Key_B:
-                self.input(ControlChar.STX.value)
-            elif key == Qt.Key_C:
-                self.input(ControlChar.ETX.value)
-            elif key == Qt.Key_D:
-                self.input(ControlChar.EOT.value)
-            elif key == Qt.Key_E:
-                self.input(ControlChar.ENQ.value)
-            elif key == Qt.Key_F:
-                self.input(ControlChar.ACK.value)
-            elif key == Qt.Key_G:
-                self.input(ControlChar.BEL.value)
-            elif key == Qt.Key_H:
-                self.input(ControlChar.BS.value)
-            elif key == Qt.Key_I:
-                self.input(ControlChar.TAB.value)
-            elif key == Qt.Key_J:
-                self.input(ControlChar.LF.value)
-            elif key == Qt.Key_K:
-                self.input(ControlChar.VT.value)
-            elif key == Qt.Key_L:
-                self.input(ControlChar.FF.value)
-            elif key == Qt.Key_M:
-                self.input(ControlChar.CR.value)
-            elif key == Qt.Key_N:
-                self.input(ControlChar.SO.value)
-            elif key == Qt.Key_O:
-                self.input(ControlChar.SI.value)
-            elif key == Qt.Key_P:
-                self.input(ControlChar.DLE.value)
-            elif key == Qt.Key_Q:
-                self.input(ControlChar.DC1.value)
-            elif key == Qt.Key_R:
-                self.input(ControlChar.DC2.value)
-            elif key == Qt.Key_S:
-                self.input(ControlChar.DC3.value)
-            elif key == Qt.Key_T:
-                self.input(ControlChar.DC4.value)
-            elif key == Qt.Key_U:
-                self.input(ControlChar.NAK.value)
-            elif key == Qt.Key_V:
-                self.input(ControlChar.SYN.value)
-            elif key == Qt.Key_W:
-                self.input(ControlChar.ETB.value)
-            elif key == Qt.Key_X:
-                self.input(ControlChar.CAN.value)
-            elif key == Qt.Key_Y:
-                self.input(ControlChar.EM.value)
-            elif key == Qt.Key_Z:
-                self.input(ControlChar.SUB.value)
-            elif key == Qt.Key_BracketLeft:
-                self.input(ControlChar.ESC.value)
+            # Qt key codes of @, A-Z, [, \, ], ^ and _ equal their ASCII
+            # codes, Ctrl-<key> sends the control character key & 0x1f,
+            # e.g. Ctrl-A is SOH, Ctrl-[ is ESC
+            if 0x40 <= key <= 0x5f:
+                self.input(key & 0x1f)
             return
 
         if text:
@@ -683,5 +865,4 @@ class Terminal(TerminalBuffer, QWidget):
     def scroll_bar_changed(self, pos):
         if 0 <= pos <= len(self._buffer) - self.col_len:
             self._buffer_display_offset = pos
-            self._paint_buffer()
-            self.repaint()
+            self._request_repaint()